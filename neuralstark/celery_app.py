@@ -1,199 +1,550 @@
 from celery import Celery
+from celery.signals import worker_process_init
+from kombu import Queue
 from neuralstark.config import settings
 from neuralstark.document_parser import parse_document
 import os
+import sqlite3 # For detecting a stale ChromaDB handle
 import time # Import time module
 import logging # Import logging module
+import hashlib # For chunk content hashing
+import threading
+import gc
+import ctypes
+import ctypes.util
+import json # For queued index updates
+from collections import OrderedDict
+from typing import Optional
+import redis
 
 # LangChain imports for RAG
 from langchain_huggingface import HuggingFaceEmbeddings
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_chroma import Chroma
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    logging.warning("orjson not installed. Queued index updates will use the standard json module.")
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
+# Task hot paths log through this logger with %-style arguments, so filtered-out
+# messages are never formatted and Celery's worker handler owns the output
+logger = logging.getLogger(__name__)
+
+if settings.REDIS_SOCKET_PATH:
+    # Same-host Redis over a Unix socket skips the TCP stack on every broker round trip
+    broker_url = f"redis+socket://{settings.REDIS_SOCKET_PATH}?virtual_host={settings.REDIS_BROKER_DB}"
+    backend_url = f"socket://{settings.REDIS_SOCKET_PATH}?virtual_host={settings.REDIS_BACKEND_DB}"
+else:
+    broker_url = f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_BROKER_DB}"
+    backend_url = f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_BACKEND_DB}"
 
 celery_app = Celery(
     "neuralstark_tasks",
-    broker=f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}",
-    backend=f"redis://{settings.REDIS_HOST}:{settings.REDIS_PORT}/{settings.REDIS_DB}"
+    broker=broker_url,
+    backend=backend_url
 )
 
 celery_app.conf.update(
     task_track_started=True,
     task_acks_late=True,
     worker_prefetch_multiplier=1,
+    worker_max_tasks_per_child=settings.CELERY_MAX_TASKS_PER_CHILD, # Recycle children to bound torch/Chroma memory growth
+    worker_concurrency=settings.CELERY_CONCURRENCY, # Prefork children; each holds its own copy of the embedding model
     task_serializer='json',
-    result_serializer='json',
-    accept_content=['json'],
+    result_serializer='msgpack',
+    accept_content=['json', 'msgpack'],
+    task_ignore_result=True, # Nothing reads task results; tasks that need one opt in with ignore_result=False
     timezone='UTC',
     enable_utc=True,
     broker_connection_retry_on_startup=True,
+    result_expires=3600, # Evict finished task results after an hour
+    result_backend_transport_options={'global_keyprefix': 'neuralstark:'},
+    # Parsing and embedding run on separate queues so they can be scaled independently.
+    # A worker started without -Q consumes both.
+    task_queues=(Queue("parse"), Queue("embed")),
+    task_default_queue="parse",
+    task_routes={
+        "neuralstark.celery_app.process_document_task": {"queue": "parse"},
+        "neuralstark.celery_app.flush_index_batch": {"queue": "embed"},
+    },
 )
 
-# Initialize LangChain components
-# For BGE-M3, we use HuggingFaceEmbeddings
-embeddings = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL_NAME, model_kwargs={'device': 'cpu'}, encode_kwargs={'batch_size': settings.EMBEDDING_BATCH_SIZE})
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+# LangChain components are created lazily: the watcher imports this module only to enqueue
+# tasks and must not load the embedding model. The API does load it, on purpose, through
+# get_embeddings() so queries are embedded with the same configuration as the indexed chunks.
+_embeddings = None
+_text_splitter = None
+# Guards lazy initialization under threaded/gevent pools, where model loading can yield.
+# Re-entrant because the splitter and the store build on get_embeddings().
+_init_lock = threading.RLock()
 
-# Ensure the ChromaDB directory exists on startup
-os.makedirs(settings.CHROMA_DB_PATH, exist_ok=True)
+def get_embeddings() -> HuggingFaceEmbeddings:
+    """Returns the worker's embedding model, loading it on first use."""
+    global _embeddings
+    with _init_lock:
+        if _embeddings is None:
+            model_kwargs = {'device': 'cpu'}
+            if settings.EMBEDDING_BACKEND != "torch":
+                # `backend` needs sentence-transformers >= 3.2; the default torch setup works with older releases too
+                model_kwargs['backend'] = settings.EMBEDDING_BACKEND
+            if settings.EMBEDDING_BACKEND == "onnx" and settings.EMBEDDING_ONNX_FILE:
+                # e.g. a dynamically quantized export: onnx/model_qint8_avx512_vnni.onnx
+                model_kwargs['model_kwargs'] = {'file_name': settings.EMBEDDING_ONNX_FILE}
+            # For BGE-M3, we use HuggingFaceEmbeddings
+            _embeddings = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL_NAME, model_kwargs=model_kwargs, encode_kwargs={'batch_size': settings.EMBEDDING_BATCH_SIZE})
+    return _embeddings
 
+def get_sentence_transformer():
+    """Returns the SentenceTransformer wrapped by the LangChain embeddings."""
+    embeddings = get_embeddings()
+    # langchain_huggingface keeps it on `_client` (older releases: `client`)
+    return getattr(embeddings, "_client", None) or getattr(embeddings, "client", None)
 
-@celery_app.task(bind=True)
-def process_document_task(self, file_path: str, event_type: str):
-    """Celery task to process document changes."""
-    print(f"Processing document: {file_path} (Event: {event_type})")
-    
-    # Initialize ChromaDB client inside the task to avoid file locking issues
-    # Initialize LangChain components
-# For BGE-M3, we use HuggingFaceEmbeddings
-embeddings = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL_NAME, model_kwargs={'device': 'cpu'}, encode_kwargs={'batch_size': settings.EMBEDDING_BATCH_SIZE})
-text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+def get_text_splitter():
+    """Returns the chunker selected by settings.TEXT_SPLITTER, building it on first use."""
+    global _text_splitter
+    with _init_lock:
+        if _text_splitter is None:
+            if settings.TEXT_SPLITTER == "token":
+                # Split on paragraph/line/sentence/word boundaries, then greedily merge the pieces
+                # up to a budget measured in the embedding model's own tokens (Rust tokenizer)
+                model = get_sentence_transformer()
+                # The encoder silently truncates anything longer than max_seq_length (256 for
+                # all-MiniLM-L6-v2); leave room for the [CLS]/[SEP] tokens it adds
+                chunk_size = min(settings.CHUNK_SIZE_TOKENS, model.max_seq_length - 2)
+                _text_splitter = RecursiveCharacterTextSplitter.from_huggingface_tokenizer(
+                    model.tokenizer,
+                    chunk_size=chunk_size,
+                    chunk_overlap=min(settings.CHUNK_OVERLAP_TOKENS, chunk_size // 2),
+                )
+            else:
+                _text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
+    return _text_splitter
 
-# Ensure the ChromaDB directory exists on startup
-os.makedirs(settings.CHROMA_DB_PATH, exist_ok=True)
+# Resolved once; used to classify every processed file as internal or external
+INTERNAL_KB_ABS_PATH = os.path.abspath(settings.INTERNAL_KNOWLEDGE_BASE_PATH)
+EXTERNAL_KB_ABS_PATH = os.path.abspath(settings.EXTERNAL_KNOWLEDGE_BASE_PATH)
 
-@celery_app.task(bind=True)
-def process_document_task(self, file_path: str, event_type: str):
-    """Celery task to process document changes."""
-    print(f"Processing document: {file_path} (Event: {event_type})")
-    
-    # Initialize ChromaDB client inside the task to avoid file locking issues
-    vector_store = Chroma(persist_directory=settings.CHROMA_DB_PATH, embedding_function=embeddings)
+# Parsed chunks wait in Redis so several documents are embedded and inserted together
+if settings.REDIS_SOCKET_PATH:
+    redis_client = redis.Redis(unix_socket_path=settings.REDIS_SOCKET_PATH, db=settings.REDIS_DB)
+else:
+    redis_client = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+PENDING_CHUNKS_KEY = "neuralstark:pending_chunks"
+# The batch being flushed; kept until its upserts succeed so a crashed flush is picked up again
+PROCESSING_CHUNKS_KEY = "neuralstark:processing_chunks"
+FLUSH_SCHEDULED_KEY = "neuralstark:flush_scheduled"
+FLUSH_LOCK_KEY = "neuralstark:flush_lock"
+DOC_HASH_KEY_PREFIX = "neuralstark:doc_hash:" # Content hash of the indexed version, set once a flush writes it
+QUEUED_HASH_KEY_PREFIX = "neuralstark:queued_hash:" # Content hash of a version still waiting to be flushed
+FILE_SIGNATURE_KEY_PREFIX = "neuralstark:file_signature:" # File signature of the indexed version, set with its doc hash
 
-    # Normalize file_path for consistent ID generation
-    normalized_file_path = os.path.abspath(file_path)
+# Queued updates carry whole documents' chunk text, so serialize them with orjson when available
+def _dumps(obj) -> bytes:
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode("utf-8")
 
-    # Determine if the file is internal or external
-    source_type = "unknown"
-    if normalized_file_path.startswith(os.path.abspath(settings.INTERNAL_KNOWLEDGE_BASE_PATH)):
-        source_type = "internal"
-    elif normalized_file_path.startswith(os.path.abspath(settings.EXTERNAL_KNOWLEDGE_BASE_PATH)):
-        source_type = "external"
+_loads = orjson.loads if orjson else json.loads
 
-    if event_type == "deleted":
-        print(f"Handling deletion for {file_path}. Removing from knowledge base.")
-        try:
-            vector_store.delete(where={"source": normalized_file_path})
-            print(f"Successfully removed {file_path} from ChromaDB.")
-            return {"status": "deleted", "file_path": file_path}
-        except Exception as e:
-            print(f"Error during deletion for {file_path}: {e}")
-            self.retry(exc=e, countdown=5, max_retries=3)
+# Deletes a queued-hash key only if it still names the given version, i.e. nothing newer was queued since
+_clear_queued_hash = redis_client.register_script(
+    "if redis.call('GET', KEYS[1]) == ARGV[1] then return redis.call('DEL', KEYS[1]) end return 0"
+)
 
-    # For 'created' or 'modified' events
+# Returns the processing list if an interrupted flush left one, otherwise atomically moves up to
+# ARGV[1] updates from the head of the pending list into it (scripts run atomically on any Redis version)
+_claim_index_updates = redis_client.register_script("""
+local claimed = redis.call('LRANGE', KEYS[2], 0, -1)
+if #claimed > 0 then return claimed end
+claimed = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #claimed > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(claimed))
+    redis.call('LTRIM', KEYS[1], #claimed, -1)
+end
+return claimed
+""")
+
+# Applied only when the collection is first created (neither reset recreates it; see the README):
+# batches HNSW updates instead of syncing per add, and sets the graph's build/search breadth
+collection_metadata = {
+    "hnsw:batch_size": settings.CHROMA_HNSW_BATCH_SIZE,
+    "hnsw:sync_threshold": settings.CHROMA_HNSW_SYNC_THRESHOLD,
+    "hnsw:M": settings.CHROMA_HNSW_M,
+    "hnsw:construction_ef": settings.CHROMA_HNSW_CONSTRUCTION_EF,
+    "hnsw:search_ef": settings.CHROMA_HNSW_SEARCH_EF,
+}
+
+# One Chroma store per worker process, reused across tasks
+_vector_store = None
+
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode=WAL", # Readers (the API) no longer block on the worker's writes
+    "PRAGMA synchronous=NORMAL", # No fsync per commit; still crash-consistent under WAL
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456", # 256 MiB
+    "PRAGMA cache_size=-262144", # 256 MiB page cache
+)
+
+def tune_sqlite(vector_store: Chroma):
+    """Applies SQLITE_PRAGMAS to the connection Chroma uses in this process."""
     try:
-        start_time = time.time()
-        extracted_text = parse_document(file_path)
-        parsing_time = time.time() - start_time
-        logging.info(f"Document parsing for {file_path} took {parsing_time:.4f} seconds.")
+        from chromadb.db.impl.sqlite import SqliteDB
+        conn = vector_store._client._system.instance(SqliteDB)._conn_pool.connect()
+        for pragma in SQLITE_PRAGMAS:
+            conn.execute(pragma)
+    except Exception as e:
+        # Chroma internals differ across releases; tuning is optional
+        logger.warning("Could not apply SQLite pragmas to ChromaDB: %s", e)
 
-        if extracted_text:
-            print(f"Successfully extracted text from {file_path}. Length: {len(extracted_text)} characters.")
-            
-            # If modified, delete existing chunks for this source first
-            if event_type == "modified":
-                print(f"Handling modification for {file_path}. Deleting old chunks from ChromaDB.")
-                try:
-                    vector_store.delete(where={"source": normalized_file_path})
-                    print(f"Successfully deleted old chunks for {file_path}.")
-                except Exception as e:
-                    print(f"Error deleting old chunks for {file_path}: {e}")
-                    # Continue to add new ones, but log the error
+def get_vector_store() -> Chroma:
+    """Returns the worker's Chroma store, creating it on first use."""
+    global _vector_store
+    with _init_lock:
+        if _vector_store is None:
+            os.makedirs(settings.CHROMA_DB_PATH, exist_ok=True)
+            _vector_store = Chroma(persist_directory=settings.CHROMA_DB_PATH, embedding_function=get_embeddings(), collection_metadata=collection_metadata)
+            if settings.CHROMA_SQLITE_TUNING:
+                tune_sqlite(_vector_store)
+    return _vector_store
 
-            # Split text into chunks
-            texts = text_splitter.split_text(extracted_text)
-            
-            # Prepare metadata for each chunk
-            metadatas = [{
-                "source": normalized_file_path,
-                "file_name": os.path.basename(file_path),
-                "event_type": event_type,
-                "timestamp": os.path.getmtime(file_path), # Last modified timestamp
-                "source_type": source_type # Add source type metadata
-            } for _ in texts]
-
-            # Add documents to ChromaDB
-            start_time = time.time()
-            vector_store.add_texts(texts=texts, metadatas=metadatas)
-            indexing_time = time.time() - start_time
-            logging.info(f"Indexing {len(texts)} chunks from {file_path} took {indexing_time:.4f} seconds.")
-            
-            print(f"Successfully indexed {len(texts)} chunks from {file_path} into ChromaDB.")
-            return {"status": "indexed", "file_path": file_path, "chunks_indexed": len(texts)}
+def reset_vector_store():
+    """Drops the cached Chroma store so the next get_vector_store() reopens it."""
+    global _vector_store
+    _vector_store = None
+
+def compile_embedding_model():
+    """Wraps the sentence-transformer encoder in torch.compile and runs a warm-up pass."""
+    model = get_sentence_transformer()
+    if model is None or settings.EMBEDDING_BACKEND != "torch":
+        logger.warning("torch.compile is only applied to the torch embedding backend. Skipping.")
+        return
+    eager_model = model[0].auto_model
+    try:
+        import torch
+        model[0].auto_model = torch.compile(eager_model, mode="reduce-overhead", dynamic=True)
+        start_time = time.perf_counter()
+        get_embeddings().embed_documents(["warmup"])
+        logger.info("Compiling the embedding model took %.4f seconds.", time.perf_counter() - start_time)
+    except Exception as e:
+        logger.error("Error compiling the embedding model, using eager mode: %s", e)
+        model[0].auto_model = eager_model
+
+def consumes_queue(name: str) -> bool:
+    """True if this worker consumes queue `name`: it was listed in -Q, or -Q was not given."""
+    return name in celery_app.amqp.queues.consume_from
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Prepares a worker child before its first task. Only workers on the embed queue load the
+    embedding model and open the Chroma store; parse-only workers just build the splitter."""
+    start_time = time.perf_counter()
+    if consumes_queue("embed"):
+        get_vector_store()
+        if settings.EMBEDDING_TORCH_COMPILE:
+            compile_embedding_model() # Includes a warm-up pass
         else:
-            print(f"Could not extract text from {file_path}.")
-            return {"status": "failed_extraction", "file_path": file_path}
+            get_embeddings().embed_documents(["warmup " * 32])
+    get_text_splitter() # The character splitter needs no model; the token splitter loads it for its tokenizer
+    logger.info("Worker warm-up took %.4f seconds.", time.perf_counter() - start_time)
+
+# Chunk embeddings keyed by content hash, shared across tasks in this worker process.
+# Boilerplate (headers, footers, repeated tables) is embedded only once.
+_embedding_cache = OrderedDict()
+
+# Stored with every chunk, so vectors produced by a different model are never reused
+EMBEDDING_FINGERPRINT = f"{settings.EMBEDDING_MODEL_NAME}|{settings.EMBEDDING_BACKEND}|{settings.EMBEDDING_ONNX_FILE}"
+
+def _chunk_hash(text: str) -> bytes:
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+def seed_embedding_cache(stored: dict):
+    """Loads stored chunks (a collection.get result) into the embedding cache so unchanged chunks are reused.
+    Only chunks embedded by the current model (see EMBEDDING_FINGERPRINT) are loaded."""
+    for text, vector, metadata in zip(stored["documents"], stored["embeddings"], stored["metadatas"]):
+        if not metadata or metadata.get("embedding_model") != EMBEDDING_FINGERPRINT:
+            continue
+        # Chroma returns numpy rows; tolist() converts in C instead of per element
+        _embedding_cache[_chunk_hash(text)] = vector.tolist() if hasattr(vector, "tolist") else list(vector)
+
+def embed_chunks(texts: list) -> list:
+    """Embeds chunks, skipping the model for byte-identical chunks already seen."""
+    chunk_hashes = [_chunk_hash(text) for text in texts]
+
+    to_encode = {}
+    for h, text in zip(chunk_hashes, texts):
+        if h in _embedding_cache:
+            _embedding_cache.move_to_end(h)
+        elif h not in to_encode:
+            to_encode[h] = text
+
+    if to_encode:
+        vectors = get_embeddings().embed_documents(list(to_encode.values()))
+        for h, vector in zip(to_encode.keys(), vectors):
+            _embedding_cache[h] = vector
+
+    result = [_embedding_cache[h] for h in chunk_hashes]
+
+    while len(_embedding_cache) > settings.EMBEDDING_CACHE_SIZE:
+        _embedding_cache.popitem(last=False)
+
+    logger.info("Embedded %d unique chunks out of %d.", len(to_encode), len(texts))
+    return result
+
+# glibc keeps freed arenas mapped; malloc_trim hands them back to the OS between batches
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6")
+    _malloc_trim = _libc.malloc_trim
+except (OSError, AttributeError):
+    _malloc_trim = None # Not glibc (macOS, musl)
+
+TRIM_EVERY_FLUSHES = 8
+_flush_count = 0
+
+def release_memory():
+    """Collects garbage and returns freed heap pages every TRIM_EVERY_FLUSHES batches."""
+    global _flush_count
+    _flush_count += 1
+    if _flush_count % TRIM_EVERY_FLUSHES:
+        return
+    gc.collect()
+    if _malloc_trim:
+        _malloc_trim(0)
+
+def file_signature(file_path: str, st: os.stat_result) -> str:
+    """Cheap change detector: size, mtime and a blake2b of the first 64 KB, without parsing the file."""
+    with open(file_path, "rb") as f:
+        head_hash = hashlib.blake2b(f.read(65536), digest_size=16).hexdigest()
+    return f"{st.st_size}:{st.st_mtime_ns}:{head_hash}"
+
+def queue_index_update(normalized_file_path: str, texts: list, metadata: Optional[dict] = None, content_hash: Optional[str] = None, signature: Optional[str] = None):
+    """Queues a document's replacement chunks (none for a deletion) for the next batched flush."""
+    pipe = redis_client.pipeline()
+    pipe.rpush(PENDING_CHUNKS_KEY, _dumps({
+        "source": normalized_file_path,
+        "texts": texts,
+        "metadata": metadata, # Shared by every chunk of the document
+        "content_hash": content_hash,
+        "signature": signature,
+    }))
+    # Until it is flushed, the latest queued version decides whether a 'modified' event is a no-op;
+    # an empty hash marks a queued deletion
+    pipe.set(QUEUED_HASH_KEY_PREFIX + normalized_file_path, content_hash or "")
+    pipe.execute()
+    # Schedule a flush unless one is already pending
+    if redis_client.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=int(settings.INDEX_FLUSH_INTERVAL) + 60):
+        flush_index_batch.apply_async(countdown=settings.INDEX_FLUSH_INTERVAL)
+
+def claim_index_updates(limit: int) -> list:
+    """Returns the batch to flush, oldest first: the leftovers of an interrupted flush if there are any,
+    otherwise up to `limit` queued updates moved into the processing list. Call only while holding the flush lock."""
+    raw_updates = _claim_index_updates(keys=[PENDING_CHUNKS_KEY, PROCESSING_CHUNKS_KEY], args=[limit])
+    return [_loads(raw) for raw in raw_updates]
+
+def finish_index_updates(updates, indexed: bool):
+    """Drops the processing list once its batch has been written (or given up on).
+    Written documents get their content hash and file signature recorded as indexed; either way a document's queued
+    hash is cleared unless a newer version was queued meanwhile."""
+    pipe = redis_client.pipeline() # MULTI/EXEC: the hashes and the processing list change together
+    for update in updates:
+        source = update["source"]
+        content_hash = update.get("content_hash") or ""
+        if indexed:
+            if content_hash:
+                pipe.set(DOC_HASH_KEY_PREFIX + source, content_hash)
+            else:
+                pipe.delete(DOC_HASH_KEY_PREFIX + source)
+            if update.get("signature"):
+                pipe.set(FILE_SIGNATURE_KEY_PREFIX + source, update["signature"])
+            else:
+                pipe.delete(FILE_SIGNATURE_KEY_PREFIX + source)
+        _clear_queued_hash(keys=[QUEUED_HASH_KEY_PREFIX + source], args=[content_hash], client=pipe)
+    pipe.delete(PROCESSING_CHUNKS_KEY)
+    pipe.execute()
+
+@celery_app.task(bind=True, max_retries=3)
+def flush_index_batch(self):
+    """Celery task that applies queued document updates to ChromaDB in one batch."""
+    # One flush at a time: concurrent flushes could apply an older version of a document
+    # after a newer one, or delete chunks another flush just wrote
+    lock = redis_client.lock(FLUSH_LOCK_KEY, timeout=settings.INDEX_FLUSH_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        # The running flush reschedules itself if updates are left when it finishes; try again
+        # later in case it dies first
+        flush_index_batch.apply_async(countdown=settings.INDEX_FLUSH_INTERVAL)
+        return {"status": "busy"}
+    try:
+        return _flush_index_batch(self, lock)
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            logger.warning("Flush lock expired before the flush finished; raise INDEX_FLUSH_LOCK_TIMEOUT.")
+
+def _flush_index_batch(task, lock) -> dict:
+    """Body of flush_index_batch, run while holding the flush lock."""
+    latest = {}
+    try:
+        # Clear the flag before claiming so updates queued from now on schedule a new flush
+        redis_client.delete(FLUSH_SCHEDULED_KEY)
+        updates = claim_index_updates(settings.INDEX_FLUSH_MAX_DOCS)
+        if not updates:
+            return {"status": "empty"}
+
+        # Only the latest update per document matters
+        for update in updates:
+            latest[update["source"]] = update
+        sources = list(latest.keys())
+
+        ids = []
+        texts = []
+        metadatas = []
+        for source, update in latest.items():
+            chunk_count = len(update["texts"])
+            # Stable per-chunk IDs: <source>::<chunk index>
+            ids.extend(f"{source}::{i}" for i in range(chunk_count))
+            texts.extend(update["texts"])
+            if chunk_count:
+                metadatas.extend([dict(update["metadata"], embedding_model=EMBEDDING_FINGERPRINT)] * chunk_count)
+
+        vector_store = get_vector_store()
+        start_time = time.perf_counter()
+        stored = vector_store._collection.get(where={"source": {"$in": sources}}, include=["documents", "embeddings", "metadatas"])
+        # Chunks that survived an edit keep their stored vectors instead of being re-embedded
+        seed_embedding_cache(stored)
+        # Embed and upsert in bounded slices: keeps each SQLite transaction/HNSW update in Chroma's
+        # efficient range and below the client's max batch size
+        step = settings.CHROMA_ADD_BATCH_SIZE
+        for i in range(0, len(texts), step):
+            vector_store._collection.upsert(
+                ids=ids[i:i + step],
+                embeddings=embed_chunks(texts[i:i + step]),
+                documents=texts[i:i + step],
+                metadatas=metadatas[i:i + step],
+            )
+            # Reset the lock's TTL after each slice so a large batch can't outlive it and overlap
+            # with another flush; raises if the lock was already lost
+            lock.reacquire()
+        # Chunk IDs are stable, so only chunks past a document's new length (or of deleted documents) are removed
+        stale_ids = set(stored["ids"]).difference(ids)
+        if stale_ids:
+            vector_store._collection.delete(ids=list(stale_ids))
+        finish_index_updates(latest.values(), indexed=True)
+        indexing_time = time.perf_counter() - start_time
+        logger.info("Indexing %d chunks from %d documents took %.4f seconds.", len(texts), len(sources), indexing_time)
     except Exception as e:
-        print(f"Error processing {file_path}: {e}")
-        self.retry(exc=e, countdown=5, max_retries=3)
+        logger.error("Error flushing index batch: %s", e)
+        if isinstance(e, sqlite3.OperationalError):
+            # The cached store's database handle went stale; reopen it on retry
+            reset_vector_store()
+        if task.request.retries >= task.max_retries:
+            # Give up on this batch so it doesn't block later updates; its documents are
+            # re-indexed on their next change
+            logger.error("Dropping a batch of %d documents after %d retries.", len(latest), task.request.retries)
+            if latest:
+                finish_index_updates(latest.values(), indexed=False)
+            raise
+        # The batch stays in the processing list, so the retry (or any later flush) picks it up
+        raise task.retry(exc=e, countdown=5)
+
+    total_chunks = len(texts)
+    # Drop the batch's text and vectors before the next batch is popped
+    del stored, texts, metadatas, ids, latest, updates
+    release_memory()
+
+    # Pick up anything that was queued beyond this batch
+    if redis_client.llen(PENDING_CHUNKS_KEY) and redis_client.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=int(settings.INDEX_FLUSH_INTERVAL) + 60):
+        flush_index_batch.delay()
+
+    return {"status": "indexed", "documents": len(sources), "chunks_indexed": total_chunks}
 
+@celery_app.task(bind=True)
+def process_document_task(self, file_path: str, event_type: str):
+    """Celery task to process document changes."""
+    logger.info("Processing document: %s (Event: %s)", file_path, event_type)
 
     # Normalize file_path for consistent ID generation
     normalized_file_path = os.path.abspath(file_path)
 
     # Determine if the file is internal or external
     source_type = "unknown"
-    if normalized_file_path.startswith(os.path.abspath(settings.INTERNAL_KNOWLEDGE_BASE_PATH)):
+    if normalized_file_path.startswith(INTERNAL_KB_ABS_PATH):
         source_type = "internal"
-    elif normalized_file_path.startswith(os.path.abspath(settings.EXTERNAL_KNOWLEDGE_BASE_PATH)):
+    elif normalized_file_path.startswith(EXTERNAL_KB_ABS_PATH):
         source_type = "external"
 
     if event_type == "deleted":
-        print(f"Handling deletion for {file_path}. Removing from knowledge base.")
         try:
-            vector_store.delete(where={"source": normalized_file_path})
-            print(f"Successfully removed {file_path} from ChromaDB.")
-            return {"status": "deleted", "file_path": file_path}
+            queue_index_update(normalized_file_path, [])
+            return {"status": "deletion_queued", "file_path": file_path}
         except Exception as e:
-            print(f"Error during deletion for {file_path}: {e}")
+            logger.error("Error during deletion for %s: %s", file_path, e)
             self.retry(exc=e, countdown=5, max_retries=3)
 
     # For 'created' or 'modified' events
     try:
-        start_time = time.time()
+        # Same size, mtime and leading bytes as the last indexed version: skip even the parse
+        st = os.stat(file_path) # One stat serves the signature and the timestamp metadata
+        signature = file_signature(file_path, st)
+        queued_hash, indexed_hash, indexed_signature = redis_client.mget(
+            QUEUED_HASH_KEY_PREFIX + normalized_file_path,
+            DOC_HASH_KEY_PREFIX + normalized_file_path,
+            FILE_SIGNATURE_KEY_PREFIX + normalized_file_path,
+        )
+        # Only trusted when no other version is waiting to be flushed
+        if event_type == "modified" and queued_hash is None and indexed_signature == signature.encode():
+            logger.info("%s is unchanged on disk. Skipping re-indexing.", file_path)
+            return {"status": "unchanged", "file_path": file_path}
+
+        start_time = time.perf_counter()
         extracted_text = parse_document(file_path)
-        parsing_time = time.time() - start_time
-        logging.info(f"Document parsing for {file_path} took {parsing_time:.4f} seconds.")
+        parsing_time = time.perf_counter() - start_time
 
         if extracted_text:
-            print(f"Successfully extracted text from {file_path}. Length: {len(extracted_text)} characters.")
-            
-            # If modified, delete existing chunks for this source first
-            if event_type == "modified":
-                print(f"Handling modification for {file_path}. Deleting old chunks from ChromaDB.")
-                try:
-                    vector_store.delete(where={"source": normalized_file_path})
-                    print(f"Successfully deleted old chunks for {file_path}.")
-                except Exception as e:
-                    print(f"Error deleting old chunks for {file_path}: {e}")
-                    # Continue to add new ones, but log the error
+            logger.info("Parsed %s in %.4f seconds. Length: %d characters.", file_path, parsing_time, len(extracted_text))
+
+            # Editor saves, touch and rsync fire 'modified' without changing the content
+            content_hash = hashlib.sha256(extracted_text.encode("utf-8")).hexdigest()
+            # A version still waiting to be flushed supersedes the indexed one
+            current_hash = queued_hash if queued_hash is not None else indexed_hash
+            if event_type == "modified" and current_hash == content_hash.encode():
+                if queued_hash is None:
+                    # The indexed version matches the file; remember the new signature so the next touch is caught before parsing
+                    redis_client.set(FILE_SIGNATURE_KEY_PREFIX + normalized_file_path, signature)
+                logger.info("Content of %s is unchanged. Skipping re-indexing.", file_path)
+                return {"status": "unchanged", "file_path": file_path}
 
             # Split text into chunks
-            texts = text_splitter.split_text(extracted_text)
+            texts = get_text_splitter().split_text(extracted_text)
+            del extracted_text # Only the chunks are needed from here on
             
-            # Prepare metadata for each chunk
-            metadatas = [{
+            # Prepare the metadata shared by every chunk
+            metadata = {
                 "source": normalized_file_path,
                 "file_name": os.path.basename(file_path),
                 "event_type": event_type,
-                "timestamp": os.path.getmtime(file_path), # Last modified timestamp
-                "source_type": source_type # Add source type metadata
-            } for _ in texts]
-
-            # Add documents to ChromaDB
-            start_time = time.time()
-            vector_store.add_texts(texts=texts, metadatas=metadatas)
-            indexing_time = time.time() - start_time
-            logging.info(f"Indexing {len(texts)} chunks from {file_path} took {indexing_time:.4f} seconds.")
-            
-            print(f"Successfully indexed {len(texts)} chunks from {file_path} into ChromaDB.")
-            return {"status": "indexed", "file_path": file_path, "chunks_indexed": len(texts)}
+                "timestamp": st.st_mtime, # Last modified timestamp
+                "source_type": source_type, # Add source type metadata
+                "content_hash": content_hash,
+            }
+
+            # Old chunks for this source are replaced when the batch is flushed
+            queue_index_update(normalized_file_path, texts, metadata, content_hash, signature)
+
+            logger.info("Queued %d chunks from %s for indexing.", len(texts), file_path)
+            return {"status": "queued", "file_path": file_path, "chunks_queued": len(texts)}
         else:
-            print(f"Could not extract text from {file_path}.")
+            logger.warning("Could not extract text from %s.", file_path)
             return {"status": "failed_extraction", "file_path": file_path}
     except Exception as e:
-        print(f"Error processing {file_path}: {e}")
+        logger.error("Error processing %s: %s", file_path, e)
         self.retry(exc=e, countdown=5, max_retries=3)
+
+def enqueue_documents(file_paths: list, event_type: str):
+    """Enqueues process_document_task for many files over a single broker connection."""
+    with celery_app.producer_or_acquire() as producer:
+        for file_path in file_paths:
+            process_document_task.apply_async((file_path, event_type), producer=producer)
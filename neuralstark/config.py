@@ -8,10 +8,19 @@ class Settings:
     REDIS_HOST: str = os.getenv("REDIS_HOST", "localhost")
     REDIS_PORT: int = int(os.getenv("REDIS_PORT", 6379))
     REDIS_DB: int = int(os.getenv("REDIS_DB", 0))
+    REDIS_SOCKET_PATH: str = os.getenv("REDIS_SOCKET_PATH", "") # e.g. /var/run/redis/redis.sock; overrides host/port when set
+    # Celery broker and result backend live in separate Redis DBs so result writes don't contend with queue pops
+    REDIS_BROKER_DB: int = int(os.getenv("REDIS_BROKER_DB", REDIS_DB))
+    REDIS_BACKEND_DB: int = int(os.getenv("REDIS_BACKEND_DB", 1))
+
+    # Celery worker settings
+    CELERY_MAX_TASKS_PER_CHILD: int = int(os.getenv("CELERY_MAX_TASKS_PER_CHILD", 200))
+    CELERY_CONCURRENCY: int = int(os.getenv("CELERY_CONCURRENCY", max(2, (os.cpu_count() or 2) // 2)))
 
     # Watchdog settings
     INTERNAL_KNOWLEDGE_BASE_PATH: str = os.getenv("INTERNAL_KNOWLEDGE_BASE_PATH", "neuralstark/knowledge_base/internal")
     EXTERNAL_KNOWLEDGE_BASE_PATH: str = os.getenv("EXTERNAL_KNOWLEDGE_BASE_PATH", "neuralstark/knowledge_base/external")
+    WATCHER_DEBOUNCE_SECONDS: float = float(os.getenv("WATCHER_DEBOUNCE_SECONDS", 2.0)) # Quiet period before a file event is processed
 
     # AI settings (for LLM chat model)
     LLM_MODEL: str = os.getenv("LLM_MODEL", "gemini-2.5-flash") # Default to a common chat model
@@ -20,15 +29,45 @@ class Settings:
     # Embedding settings
     # EMBEDDING_MODEL_NAME: str = os.getenv("EMBEDDING_MODEL_NAME", "BAAI/bge-m3")
     EMBEDDING_MODEL_NAME: str = os.getenv("EMBEDDING_MODEL_NAME", "all-MiniLM-L6-v2")
+    # sentence-transformers inference backend: "torch", "onnx" (needs optimum[onnxruntime]) or "openvino"
+    EMBEDDING_BACKEND: str = os.getenv("EMBEDDING_BACKEND", "torch")
+    # ONNX weights file inside the model repo, e.g. "onnx/model_qint8_avx512_vnni.onnx" for int8 dynamic quantization
+    EMBEDDING_ONNX_FILE: str = os.getenv("EMBEDDING_ONNX_FILE", "")
+    # Compile the torch encoder in each worker child (slow first start, faster inference)
+    EMBEDDING_TORCH_COMPILE: bool = os.getenv("EMBEDDING_TORCH_COMPILE", "false").lower() == "true"
     EMBEDDING_API_KEY: str = os.getenv("EMBEDDING_API_KEY", "") # Not needed for local BGE-M3, but good for API-based embeddings
 
+    # Chunking: "character" (1000 chars, 200 overlap) or "token" (boundary-aware, sized in embedding-model tokens)
+    TEXT_SPLITTER: str = os.getenv("TEXT_SPLITTER", "character")
+    CHUNK_SIZE_TOKENS: int = int(os.getenv("CHUNK_SIZE_TOKENS", 384))
+    CHUNK_OVERLAP_TOKENS: int = int(os.getenv("CHUNK_OVERLAP_TOKENS", 64))
+
     # ChromaDB settings
     CHROMA_DB_PATH: str = os.getenv("CHROMA_DB_PATH", "./chroma_db")
+    CHROMA_ADD_BATCH_SIZE: int = int(os.getenv("CHROMA_ADD_BATCH_SIZE", 250)) # Chunks per collection upsert call
+    # HNSW buffering, applied only when the collection is created: larger values mean fewer index syncs to disk during bulk reindex
+    CHROMA_HNSW_BATCH_SIZE: int = int(os.getenv("CHROMA_HNSW_BATCH_SIZE", 1000))
+    CHROMA_HNSW_SYNC_THRESHOLD: int = int(os.getenv("CHROMA_HNSW_SYNC_THRESHOLD", 10000))
+    # HNSW graph quality, applied only when the collection is created; search_ef above Chroma's default of 10 improves recall@k
+    CHROMA_HNSW_M: int = int(os.getenv("CHROMA_HNSW_M", 16))
+    CHROMA_HNSW_CONSTRUCTION_EF: int = int(os.getenv("CHROMA_HNSW_CONSTRUCTION_EF", 100))
+    CHROMA_HNSW_SEARCH_EF: int = int(os.getenv("CHROMA_HNSW_SEARCH_EF", 64))
+    # WAL journal, synchronous=NORMAL and in-memory temp tables on the worker's Chroma SQLite connection
+    CHROMA_SQLITE_TUNING: bool = os.getenv("CHROMA_SQLITE_TUNING", "true").lower() == "true"
 
     # Canvas settings
     CANVAS_TEMPLATES_PATH: str = os.getenv("CANVAS_TEMPLATES_PATH", "canvas_templates.json")
 
     # Embedding optimization
     EMBEDDING_BATCH_SIZE: int = int(os.getenv("EMBEDDING_BATCH_SIZE", 32)) # Default batch size for embeddings
+    INDEX_FLUSH_INTERVAL: float = float(os.getenv("INDEX_FLUSH_INTERVAL", 5)) # Seconds to gather documents before a batched insert
+    INDEX_FLUSH_MAX_DOCS: int = int(os.getenv("INDEX_FLUSH_MAX_DOCS", 64)) # Max documents embedded and inserted per batch
+    INDEX_FLUSH_LOCK_TIMEOUT: int = int(os.getenv("INDEX_FLUSH_LOCK_TIMEOUT", 900)) # Seconds before a crashed flush's lock expires
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", 10000)) # Max chunk embeddings kept in memory per worker, keyed by content hash
+    QUERY_EMBEDDING_CACHE_SIZE: int = int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 1024)) # Query vectors memoized by the API process
 
 settings = Settings()
+
+# chromadb reads this whenever a client is created (API, workers and reset alike), so the
+# posthog telemetry client is never started; set ANONYMIZED_TELEMETRY=True to opt back in
+os.environ.setdefault("ANONYMIZED_TELEMETRY", "False")
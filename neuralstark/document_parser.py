@@ -42,12 +42,10 @@ def parse_pdf_file(file_path: str) -> Optional[str]:
         logging.error("pypdf is not installed. Cannot parse PDF files.")
         return None
     try:
-        text = ""
         with open(file_path, 'rb') as f:
             reader = pypdf.PdfReader(f)
-            for page in reader.pages:
-                text += page.extract_text() or ""
-        return text
+            # Join once instead of re-copying the growing string for every page
+            return "".join(page.extract_text() or "" for page in reader.pages)
     except Exception as e:
         logging.error(f"Error parsing PDF file {file_path}: {e}")
         return None
@@ -114,27 +112,26 @@ def parse_odt_file(file_path: str) -> Optional[str]:
         logging.error(f"Error parsing ODT file {file_path}: {e}")
         return None
 
+# Maps a lowercase file extension to its parser
+PARSERS = {
+    '.txt': parse_text_file,
+    '.pdf': parse_pdf_file,
+    '.docx': parse_docx_file,
+    '.csv': parse_csv_file,
+    '.xls': parse_excel_file,
+    '.xlsx': parse_excel_file,
+    '.md': parse_markdown_file,
+    '.json': parse_json_file,
+    '.odt': parse_odt_file,
+}
+
 def parse_document(file_path: str) -> Optional[str]:
     """Parses a document based on its file extension."""
     _, ext = os.path.splitext(file_path)
     ext = ext.lower()
 
-    if ext == '.txt':
-        return parse_text_file(file_path)
-    elif ext == '.pdf':
-        return parse_pdf_file(file_path)
-    elif ext == '.docx':
-        return parse_docx_file(file_path)
-    elif ext == '.csv':
-        return parse_csv_file(file_path)
-    elif ext in ['.xls', '.xlsx']:
-        return parse_excel_file(file_path)
-    elif ext == '.md':
-        return parse_markdown_file(file_path)
-    elif ext == '.json':
-        return parse_json_file(file_path)
-    elif ext == '.odt':
-        return parse_odt_file(file_path)
-    else:
+    parser = PARSERS.get(ext)
+    if parser is None:
         logging.warning(f"Unsupported file type: {ext} for {file_path}")
         return None
+    return parser(file_path)
@@ -2,6 +2,8 @@ from dotenv import load_dotenv
 load_dotenv()
 
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, ORJSONResponse
 from contextlib import asynccontextmanager
 from pydantic import BaseModel
 import os
@@ -11,12 +13,19 @@ import logging # Import logging module
 import shutil # For file operations
 import chromadb # For clearing the vector store
 from typing import Optional # For optional parameters
+from functools import lru_cache
 import json # For loading canvas templates
 
+try:
+    import orjson # Serializes API responses in C
+except ImportError:
+    orjson = None
+    logging.warning("orjson not installed. API responses will use the standard json encoder.")
+
 # LangChain imports
 from langchain_google_genai import ChatGoogleGenerativeAI
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
 from langchain.chains import RetrievalQA
 from langchain.prompts import PromptTemplate
 from langchain.agents import AgentExecutor, create_react_agent
@@ -30,7 +39,7 @@ from reportlab.lib.styles import getSampleStyleSheet
 
 from neuralstark.config import settings
 from .watcher import start_watcher_in_background, stop_watcher
-from neuralstark.celery_app import process_document_task # Import Celery task
+from neuralstark.celery_app import process_document_task, enqueue_documents, collection_metadata, get_embeddings # Import Celery task
 from neuralstark.document_parser import parse_document # Import parse_document for content retrieval
 
 logging.basicConfig(level=logging.INFO,
@@ -49,13 +58,18 @@ except json.JSONDecodeError:
 
 # --- PDF Generation Functions (Tools) ---
 KNOWLEDGE_BASE_DIR = settings.INTERNAL_KNOWLEDGE_BASE_PATH # Use the configured path
+INTERNAL_KB_ABS_PATH = os.path.abspath(settings.INTERNAL_KNOWLEDGE_BASE_PATH)
+EXTERNAL_KB_ABS_PATH = os.path.abspath(settings.EXTERNAL_KNOWLEDGE_BASE_PATH)
+
+# getSampleStyleSheet() builds every style from scratch, so build it once and share it
+PDF_STYLES = getSampleStyleSheet()
 
 def generate_financial_review_pdf(data: str) -> str:
     """Generates a financial review PDF report and saves it to the knowledge_base folder.
     Input should be a JSON string containing financial data (e.g., {"company": "ABC Corp", "revenue": "$1M", "profit": "$200K"}).
     Returns the absolute path to the generated PDF file.
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
     try:
         # Ensure the knowledge_base directory exists
         os.makedirs(KNOWLEDGE_BASE_DIR, exist_ok=True)
@@ -74,19 +88,18 @@ def generate_financial_review_pdf(data: str) -> str:
         file_path = os.path.join(KNOWLEDGE_BASE_DIR, file_name)
 
         doc = SimpleDocTemplate(file_path, pagesize=letter)
-        styles = getSampleStyleSheet()
         story = []
 
-        story.append(Paragraph("Financial Review Report", styles['h1']))
+        story.append(Paragraph("Financial Review Report", PDF_STYLES['h1']))
         story.append(Spacer(1, 0.2 * 2.54 * 72)) # 0.2 inch spacer
 
         for key, value in financial_data.items():
-            story.append(Paragraph(f"<b>{key.replace('_', ' ').title()}:</b> {value}", styles['Normal']))
+            story.append(Paragraph(f"<b>{key.replace('_', ' ').title()}:</b> {value}", PDF_STYLES['Normal']))
             story.append(Spacer(1, 0.1 * 2.54 * 72))
 
         doc.build(story)
         print(f"Generated financial review PDF: {file_path}")
-        end_time = time.time()
+        end_time = time.perf_counter()
         logging.info(f"Financial review PDF generation took {end_time - start_time:.4f} seconds.")
         return file_path
     except Exception as e:
@@ -98,7 +111,7 @@ def generate_quote_pdf(quote_details: str) -> str:
     Input should be a JSON string containing quote details (e.g., {"item": "Service A", "price": "$500", "client": "Client X"}).
     Returns the absolute path to the generated PDF file.
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
     try:
         os.makedirs(KNOWLEDGE_BASE_DIR, exist_ok=True)
 
@@ -115,19 +128,18 @@ def generate_quote_pdf(quote_details: str) -> str:
         file_path = os.path.join(KNOWLEDGE_BASE_DIR, file_name)
 
         doc = SimpleDocTemplate(file_path, pagesize=letter)
-        styles = getSampleStyleSheet()
         story = []
 
-        story.append(Paragraph("Quotation", styles['h1']))
+        story.append(Paragraph("Quotation", PDF_STYLES['h1']))
         story.append(Spacer(1, 0.2 * 2.54 * 72))
 
         for key, value in details.items():
-            story.append(Paragraph(f"<b>{key.replace('_', ' ').title()}:</b> {value}", styles['Normal']))
+            story.append(Paragraph(f"<b>{key.replace('_', ' ').title()}:</b> {value}", PDF_STYLES['Normal']))
             story.append(Spacer(1, 0.1 * 2.54 * 72))
 
         doc.build(story)
         print(f"Generated quote PDF: {file_path}")
-        end_time = time.time()
+        end_time = time.perf_counter()
         logging.info(f"Quote PDF generation took {end_time - start_time:.4f} seconds.")
         return file_path
     except Exception as e:
@@ -141,7 +153,7 @@ def generate_canvas_preview(data: str) -> dict:
     Example: {"canvas_type": "bar_chart", "data": {"title": "New Title", "data": [...]}}
     Returns a JSON object representing the canvas.
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
     try:
         import json
         data = data.strip('`')
@@ -204,7 +216,7 @@ def generate_canvas_preview(data: str) -> dict:
         if "kpis" in canvas_data:
             template["kpis"] = canvas_data["kpis"]
 
-        end_time = time.time()
+        end_time = time.perf_counter()
         logging.info(f"Canvas generation for '{canvas_type}' took {end_time - start_time:.4f} seconds.")
         return {"canvas": template}
 
@@ -215,17 +227,50 @@ def generate_canvas_preview(data: str) -> dict:
 
 # --- LangChain Setup ---
 # Initialize embeddings for retrieval
-embeddings = HuggingFaceEmbeddings(model_name=settings.EMBEDDING_MODEL_NAME)
+class QueryCachedEmbeddings(Embeddings):
+    """Wraps the embedding model and memoizes query vectors; the agent and users often repeat a search."""
+
+    def __init__(self, model: Embeddings, cache_size: int):
+        self.model = model
+        self._embed_query = lru_cache(maxsize=cache_size)(lambda text: tuple(model.embed_query(text)))
+
+    def embed_documents(self, texts: list) -> list:
+        return self.model.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list:
+        return list(self._embed_query(text)) # Callers get their own copy of the cached vector
+
+# Same model and backend as the indexing worker, so query and document vectors match
+embeddings = QueryCachedEmbeddings(get_embeddings(), settings.QUERY_EMBEDDING_CACHE_SIZE)
 
 # Initialize LLM for chat and agent reasoning
 llm = ChatGoogleGenerativeAI(model=settings.LLM_MODEL, google_api_key=settings.LLM_API_KEY)
 
+# Chroma caches its client per persist directory, so re-creating the store per query
+# never refreshed anything; build it and the RAG chains once and share them.
+vector_store = Chroma(persist_directory=settings.CHROMA_DB_PATH, embedding_function=embeddings, collection_metadata=collection_metadata)
+qa_chains = {}
+
+def get_qa_chain(source_type: Optional[str]) -> RetrievalQA:
+    """Returns the RAG chain for a source_type filter ('internal', 'external' or None), building it on first use."""
+    if source_type not in qa_chains:
+        search_kwargs = {}
+        if source_type:
+            search_kwargs["filter"] = {"source_type": source_type}
+        qa_chains[source_type] = RetrievalQA.from_chain_type(
+            llm=llm,
+            chain_type="stuff",
+            retriever=vector_store.as_retriever(search_kwargs=search_kwargs),
+            return_source_documents=True
+        )
+    return qa_chains[source_type]
+
 # Custom Knowledge Base Search function to allow filtering by source_type
 def _run_knowledge_base_search(input_json_string: str) -> str:
     """Performs a knowledge base search, optionally filtering by source_type (internal/external).
     Input should be a JSON string with 'query' and optional 'source_type' (e.g., {"query": "How to cook rice?", "source_type": "external"}).
     """
-    start_time = time.time()
+    start_time = time.perf_counter()
     print(f"Performing knowledge base search for input: {input_json_string}")
     
     import json
@@ -241,41 +286,22 @@ def _run_knowledge_base_search(input_json_string: str) -> str:
     if not query:
         return "Error: 'query' key is missing in the input JSON for KnowledgeBaseSearch."
 
-    # Re-initialize ChromaDB client to ensure it reads the latest state from disk
-    # This is a temporary solution for development; for production, consider a more efficient refresh mechanism
-    current_vector_store = Chroma(persist_directory=settings.CHROMA_DB_PATH, embedding_function=embeddings)
-
-    # Build the filter for ChromaDB
-    chroma_filter = {}
-    if source_type and source_type in ["internal", "external"]:
-        chroma_filter["source_type"] = source_type
+    if source_type not in ["internal", "external"]:
+        source_type = None
 
-    # Create a retriever with the filter
-    search_kwargs = {}
-    if chroma_filter:
-        search_kwargs["filter"] = chroma_filter
-    retriever = current_vector_store.as_retriever(search_kwargs=search_kwargs)
-    
-    # Create a temporary RAG chain for this specific query
-    qa_chain_filtered = RetrievalQA.from_chain_type(
-        llm=llm,
-        chain_type="stuff",
-        retriever=retriever,
-        return_source_documents=True
-    )
-    
-    response = qa_chain_filtered.invoke({"query": query})
+    response = get_qa_chain(source_type).invoke({"query": query})
     
     # Format the response to include source documents for the agent
     valid_source_documents = [doc for doc in response["source_documents"] if doc.page_content is not None and doc.page_content.strip() != '']
 
     if valid_source_documents:
-        sources = ", ".join([os.path.basename(doc.metadata["source"]) for doc in valid_source_documents])
+        # file_name is stored at index time; dict.fromkeys drops repeats from several chunks of one file
+        sources = ", ".join(dict.fromkeys(doc.metadata.get("file_name") or os.path.basename(doc.metadata["source"]) for doc in valid_source_documents))
         final_answer = f"Answer: {response["result"]}\nSources: {sources}"
     else:
         final_answer = f"Answer: {response["result"]}\nSources: None"
 
-    end_time = time.time()
+    end_time = time.perf_counter()
     logging.info(f"Knowledge base search for '{query}' took {end_time - start_time:.4f} seconds.")
     return final_answer
 
@@ -337,6 +363,13 @@ async def lifespan(app: FastAPI):
     # Startup event
     print("Starting NeuralStark API...")
     start_watcher_in_background()
+    # Fault in the HNSW index and run the query path once so the first real search isn't the slow one
+    start_time = time.perf_counter()
+    try:
+        await run_in_threadpool(vector_store.similarity_search, "warmup", k=1)
+        logging.info(f"Retrieval warm-up took {time.perf_counter() - start_time:.4f} seconds.")
+    except Exception as e:
+        logging.warning(f"Retrieval warm-up failed: {e}")
     yield
     # Shutdown event
     print("Shutting down NeuralStark API...")
@@ -346,7 +379,8 @@ app = FastAPI(
     title="NeuralStark API",
     description="AI Chat, Tool Usage, and Document Management System",
     version="0.1.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse if orjson else JSONResponse
 )
 
 class ChatRequest(BaseModel):
@@ -366,11 +400,11 @@ async def health_check():
 @app.post("/chat")
 async def chat_endpoint(request: ChatRequest):
     print(f"Received chat query: {request.query}")
-    start_time = time.time()
+    start_time = time.perf_counter()
     try:
         # The agent will decide whether to use a tool or answer directly
-        response = agent_executor.invoke({"input": request.query})
-        end_time = time.time()
+        response = await run_in_threadpool(agent_executor.invoke, {"input": request.query})
+        end_time = time.perf_counter()
         logging.info(f"Overall chat response for '{request.query}' took {end_time - start_time:.4f} seconds.")
 
         # Try to parse the output as JSON if it's a string representation of a dict
@@ -399,11 +433,7 @@ async def chat_endpoint(request: ChatRequest):
 @app.get("/documents")
 async def list_documents():
     try:
-        # Re-initialize ChromaDB client to ensure it reads the latest state from disk
-        # This is a temporary solution for development; for production, consider a more efficient refresh mechanism
-        current_vector_store = Chroma(persist_directory=settings.CHROMA_DB_PATH, embedding_function=embeddings)
-
-        results = current_vector_store.get(include=['metadatas'])
+        results = await run_in_threadpool(vector_store.get, include=['metadatas'])
         
         unique_sources = set()
         if results and 'metadatas' in results:
@@ -416,6 +446,10 @@ async def list_documents():
         print(f"Error listing documents: {e}")
         return {"error": str(e)}, 500
 
+def _save_upload(source, file_path: str):
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(source, buffer)
+
 @app.post("/documents/upload")
 async def upload_document(source_type: str = Form(...), file: UploadFile = File(...)):
     """Uploads a new document to the knowledge base for automatic processing and indexing."""
@@ -428,8 +462,8 @@ async def upload_document(source_type: str = Form(...), file: UploadFile = File(
     file_path = os.path.join(target_dir, file.filename)
 
     try:
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Copy in a worker thread so large uploads don't block the event loop
+        await run_in_threadpool(_save_upload, file.file, file_path)
         
         # Dispatch Celery task for processing
         process_document_task.delay(file_path, "created")
@@ -444,17 +478,14 @@ async def get_document_content(file_path: str):
     """Retrieves the extracted text content of a specific document from the knowledge base."""
     # Basic security check: Ensure the file path is within the knowledge base directories
     abs_file_path = os.path.abspath(file_path)
-    internal_kb_path = os.path.abspath(settings.INTERNAL_KNOWLEDGE_BASE_PATH)
-    external_kb_path = os.path.abspath(settings.EXTERNAL_KNOWLEDGE_BASE_PATH)
-
-    if not (abs_file_path.startswith(internal_kb_path) or abs_file_path.startswith(external_kb_path)):
+    if not (abs_file_path.startswith(INTERNAL_KB_ABS_PATH) or abs_file_path.startswith(EXTERNAL_KB_ABS_PATH)):
         raise HTTPException(status_code=400, detail="File path is outside knowledge base directories.")
 
     if not os.path.exists(abs_file_path):
         raise HTTPException(status_code=404, detail="File not found.")
 
     try:
-        content = parse_document(abs_file_path)
+        content = await run_in_threadpool(parse_document, abs_file_path)
         if content is None:
             raise HTTPException(status_code=500, detail="Could not extract content from the file.")
         return {"file_path": file_path, "content": content}
@@ -467,10 +498,7 @@ async def delete_document(request: DeleteRequest):
     """Deletes a document from the knowledge base. This will also trigger its removal from the vector store."""
     # Basic security check: Ensure the file path is within the knowledge base directories
     abs_file_path = os.path.abspath(request.file_path)
-    internal_kb_path = os.path.abspath(settings.INTERNAL_KNOWLEDGE_BASE_PATH)
-    external_kb_path = os.path.abspath(settings.EXTERNAL_KNOWLEDGE_BASE_PATH)
-
-    if not (abs_file_path.startswith(internal_kb_path) or abs_file_path.startswith(external_kb_path)):
+    if not (abs_file_path.startswith(INTERNAL_KB_ABS_PATH) or abs_file_path.startswith(EXTERNAL_KB_ABS_PATH)):
         raise HTTPException(status_code=400, detail="File path is outside knowledge base directories.")
 
     if not os.path.exists(abs_file_path):
@@ -484,39 +512,51 @@ async def delete_document(request: DeleteRequest):
         logging.error(f"Error deleting file {request.file_path}: {e}")
         raise HTTPException(status_code=500, detail=f"Error deleting file: {e}")
 
+def _hard_reset():
+    """Clears the ChromaDB collection and deletes every file in the knowledge base directories."""
+    # Clear the ChromaDB vector store using the client API
+    client = chromadb.PersistentClient(path=settings.CHROMA_DB_PATH)
+    # The default collection name used by LangChain's Chroma is "langchain".
+    # Check for it up front: the not-found exception type differs across Chroma releases,
+    # and catching it also hid real errors.
+    # (list_collections returns names in Chroma >= 0.6 and Collection objects before.)
+    collection_names = {getattr(c, "name", c) for c in client.list_collections()}
+    if "langchain" in collection_names:
+        collection = client.get_collection("langchain")
+        # Get all IDs in the collection to delete them by ID
+        # This is safer than deleting and recreating the collection
+        results = collection.get(include=[]) # IDs only; skip loading documents and metadata
+        if results["ids"]:
+            collection.delete(ids=results["ids"])
+        print("Successfully cleared ChromaDB collection.")
+    else:
+        print("ChromaDB collection not found, creating a new one.")
+
+    # Delete all files in internal and external knowledge base directories
+    for dir_path in [settings.INTERNAL_KNOWLEDGE_BASE_PATH, settings.EXTERNAL_KNOWLEDGE_BASE_PATH]:
+        if os.path.exists(dir_path):
+            # scandir's DirEntry carries the file type from the directory read, no stat per file
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        os.remove(entry.path)
+
 @app.post("/knowledge_base/reset")
 async def reset_knowledge_base(reset_type: str):
     """Resets the knowledge base. 
     - 'hard': Deletes all files and clears the vector store.
-    - 'soft': Re-indexes all existing files.
+    - 'soft': Re-indexes all existing files in place. Every file is re-parsed and its chunks and
+      metadata are rewritten, and documents no longer on disk are removed. Chunks whose text is
+      unchanged and that were embedded by the current model (name, backend and ONNX file) keep their
+      stored vectors; all other chunks, including every chunk after a model change, are re-embedded.
     """
     if reset_type not in ["hard", "soft"]:
         raise HTTPException(status_code=400, detail="Invalid reset_type. Must be 'hard' or 'soft'.")
 
     try:
-        # Clear the ChromaDB vector store using the client API
-        client = chromadb.PersistentClient(path=settings.CHROMA_DB_PATH)
-        # The default collection name used by LangChain's Chroma is "langchain"
-        try:
-            collection = client.get_collection("langchain")
-            # Get all items in the collection to delete them by ID
-            # This is safer than deleting and recreating the collection
-            results = collection.get()
-            if results["ids"]:
-                collection.delete(ids=results["ids"])
-            print("Successfully cleared ChromaDB collection.")
-        except ValueError:
-            # This error is raised if the collection does not exist, which is fine.
-            print("ChromaDB collection not found, creating a new one.")
-
         if reset_type == "hard":
-            # Delete all files in internal and external knowledge base directories
-            for dir_path in [settings.INTERNAL_KNOWLEDGE_BASE_PATH, settings.EXTERNAL_KNOWLEDGE_BASE_PATH]:
-                if os.path.exists(dir_path):
-                    for filename in os.listdir(dir_path):
-                        file_path = os.path.join(dir_path, filename)
-                        if os.path.isfile(file_path):
-                            os.remove(file_path)
+            # Chroma and file system calls block, so keep them off the event loop
+            await run_in_threadpool(_hard_reset)
             return {"message": "Knowledge base has been hard reset. All files and embeddings have been deleted."}
 
         elif reset_type == "soft":
@@ -524,15 +564,20 @@ async def reset_knowledge_base(reset_type: str):
             files_to_reindex = []
             for dir_path in [settings.INTERNAL_KNOWLEDGE_BASE_PATH, settings.EXTERNAL_KNOWLEDGE_BASE_PATH]:
                 if os.path.exists(dir_path):
-                    for filename in os.listdir(dir_path):
-                        file_path = os.path.join(dir_path, filename)
-                        if os.path.isfile(file_path):
-                            files_to_reindex.append(file_path)
-            
-            for file_path in files_to_reindex:
-                process_document_task.delay(file_path, "created")
+                    with os.scandir(dir_path) as entries:
+                        files_to_reindex.extend(entry.path for entry in entries if entry.is_file())
+
+            # The collection is updated in place rather than cleared: each re-indexed document
+            # replaces its own chunks, and unchanged chunks keep their stored vectors instead of
+            # being re-embedded. Documents no longer on disk are removed explicitly.
+            results = await run_in_threadpool(vector_store.get, include=['metadatas'])
+            indexed_sources = {metadata['source'] for metadata in results['metadatas'] if metadata and 'source' in metadata}
+            stale_sources = indexed_sources.difference(os.path.abspath(path) for path in files_to_reindex)
+
+            enqueue_documents(files_to_reindex, "created")
+            enqueue_documents(list(stale_sources), "deleted")
             
-            return {"message": f"Knowledge base has been soft reset. Re-indexing {len(files_to_reindex)} files."}
+            return {"message": f"Knowledge base has been soft reset. Re-indexing {len(files_to_reindex)} files and removing {len(stale_sources)} missing ones; unchanged chunks keep their current-model vectors."}
 
     except Exception as e:
         logging.error(f"Error resetting knowledge base: {e}")
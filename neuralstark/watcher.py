@@ -1,5 +1,7 @@
 import time
+import heapq
 import logging
+import threading
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
 from neuralstark.config import settings
@@ -10,47 +12,111 @@ logging.basicConfig(level=logging.INFO,
                     datefmt='%Y-%m-%d %H:%M:%S')
 
 class DocumentEventHandler(FileSystemEventHandler):
+    def __init__(self):
+        super().__init__()
+        # Pending event per path, as (deadline, event_type); editors and rsync fire several events per save
+        self._pending = {}
+        # (deadline, path) min-heap over _pending; entries superseded by a later event are skipped when popped
+        self._deadlines = []
+        self._condition = threading.Condition()
+        self._stopped = False
+        # A single thread dispatches every path, however many are pending
+        self._thread = threading.Thread(target=self._run, name="watcher-debounce", daemon=True)
+        self._thread.start()
+
+    def _schedule(self, file_path: str, event_type: str):
+        """Enqueues the task once no further events arrive for the path within the debounce window."""
+        deadline = time.monotonic() + settings.WATCHER_DEBOUNCE_SECONDS
+        with self._condition:
+            pending = self._pending.get(file_path)
+            # A file that is created and then written to is still a new file
+            if pending and pending[1] == "created" and event_type == "modified":
+                event_type = "created"
+            self._pending[file_path] = (deadline, event_type)
+            heapq.heappush(self._deadlines, (deadline, file_path))
+            # Only the earliest deadline decides how long the thread sleeps
+            if self._deadlines[0][1] == file_path:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if not self._deadlines:
+                        self._condition.wait()
+                        continue
+                    deadline, file_path = self._deadlines[0]
+                    timeout = deadline - time.monotonic()
+                    if timeout > 0:
+                        self._condition.wait(timeout)
+                        continue
+                    heapq.heappop(self._deadlines)
+                    pending = self._pending.get(file_path)
+                    # Only dispatch if a newer event hasn't pushed the path's deadline back
+                    if pending and pending[0] == deadline:
+                        del self._pending[file_path]
+                        break
+                else:
+                    return
+            process_document_task.delay(file_path, pending[1])
+
+    def close(self):
+        """Stops the debounce thread and enqueues every event still waiting out its window."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        pending, self._pending, self._deadlines = self._pending, {}, []
+        for file_path, (_, event_type) in pending.items():
+            process_document_task.delay(file_path, event_type)
+
     def on_created(self, event):
         if not event.is_directory:
             logging.info(f"New file created: {event.src_path}")
-            process_document_task.delay(event.src_path, "created")
+            self._schedule(event.src_path, "created")
 
     def on_modified(self, event):
         if not event.is_directory:
             logging.info(f"File modified: {event.src_path}")
-            process_document_task.delay(event.src_path, "modified")
+            self._schedule(event.src_path, "modified")
 
     def on_deleted(self, event):
         if not event.is_directory:
             logging.info(f"File deleted: {event.src_path}")
-            process_document_task.delay(event.src_path, "deleted")
+            self._schedule(event.src_path, "deleted")
 
-# Global observer instance to manage its lifecycle
+# Global observer and handler instances to manage their lifecycle
 observer_instance = None
+event_handler_instance = None
 
 def start_watcher_in_background():
-    global observer_instance
+    global observer_instance, event_handler_instance
     
     internal_path = settings.INTERNAL_KNOWLEDGE_BASE_PATH
     external_path = settings.EXTERNAL_KNOWLEDGE_BASE_PATH
 
-    event_handler = DocumentEventHandler()
+    event_handler_instance = DocumentEventHandler()
     observer_instance = Observer()
     
-    observer_instance.schedule(event_handler, internal_path, recursive=True)
+    observer_instance.schedule(event_handler_instance, internal_path, recursive=True)
     logging.info(f"Watching internal directory: {internal_path}")
 
-    observer_instance.schedule(event_handler, external_path, recursive=True)
+    observer_instance.schedule(event_handler_instance, external_path, recursive=True)
     logging.info(f"Watching external directory: {external_path}")
 
     observer_instance.start()
 
 def stop_watcher():
-    global observer_instance
+    global observer_instance, event_handler_instance
     if observer_instance:
         observer_instance.stop()
         observer_instance.join()
-        logging.info("Watcher stopped.")
+        observer_instance = None
+    if event_handler_instance:
+        # After the observer: no new events can arrive, so nothing pending is lost
+        event_handler_instance.close()
+        event_handler_instance = None
+    logging.info("Watcher stopped.")
 
 if __name__ == "__main__":
     # This block is for testing the watcher independently